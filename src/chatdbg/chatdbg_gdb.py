@@ -1,3 +1,5 @@
+import functools
+import itertools
 import json
 import os
 import pathlib
@@ -7,21 +9,83 @@ import gdb
 
 import llm_utils
 
+# chatdbg_utils pulls in openai and rich, so it is only imported once `why` is used.
 sys.path.append(os.path.abspath(pathlib.Path(__file__).parent.resolve()))
-import chatdbg_utils
 
 # The file produced by the panic handler if the Rust program is using the chatdbg crate.
 rust_panic_log_filename = "panic_log.txt"
 
 
+# Contents of the Rust panic log as of its last modification time.
+_panic_cache = {"mtime": None, "data": ""}
+
+
+def _read_panic_log():
+    """Returns the Rust panic log (rereading it only if it changed), or None."""
+    try:
+        st = os.stat(rust_panic_log_filename)
+        if st.st_mtime != _panic_cache["mtime"]:
+            with open(rust_panic_log_filename, "r") as log:
+                _panic_cache["data"] = log.read()
+            _panic_cache["mtime"] = st.st_mtime
+    except OSError:
+        return None
+    return _panic_cache["data"]
+
+
 # Set the prompt to gdb-ChatDBG
 gdb.prompt_hook = lambda current_prompt: "(gdb-ChatDBG) "
 
 last_error_type = ""
 
+# Prevent pathological case where lines are REALLY long (matches llm_utils.read_lines).
+max_chars_per_line = 128
+
+# Source files larger than this are read through a bounded window instead of cached.
+max_cached_file_size = 64 * 1024
+
+
+@functools.lru_cache(maxsize=64)
+def _read_file_lines(file_path: str) -> tuple[str, ...]:
+    """Returns all lines of a file, right-stripped. Cached until the next stop."""
+    with open(file_path, "r") as f:
+        return tuple(line.rstrip() for line in f)
+
+
+# Source files we couldn't read since the last stop, so we don't keep retrying them.
+_missing_files = set()
+
+
+def _truncate(s: str) -> str:
+    if len(s) < max_chars_per_line:
+        return s
+    return s[:max_chars_per_line] + "..."
+
+
+def read_lines(file_path: str, start_line: int, end_line: int) -> tuple[list[str], int]:
+    """
+    Drop-in replacement for llm_utils.read_lines that shares one read of each
+    source file across all the frames of a stack trace. Large files are not
+    cached; only the lines up to end_line are read.
+    """
+    start_line = max(1, start_line)
+    end_line = max(0, end_line)
+    if os.stat(file_path).st_size <= max_cached_file_size:
+        lines = _read_file_lines(file_path)[start_line - 1 : end_line]
+    else:
+        # Only read as far as we need; don't hold the whole file in memory.
+        with open(file_path, "r") as f:
+            window = itertools.islice(f, start_line - 1, end_line)
+            lines = [line.rstrip() for line in window]
+    return ([_truncate(line) for line in lines], start_line)
+
 
 def stop_handler(event):
     """Sets last error type so we can report it later."""
+    # Sources may have changed since the last stop.
+    _read_file_lines.cache_clear()
+    _missing_files.clear()
+    _frame_cache.clear()
     # Check if the event is a stop event
     global last_error_type
     if not hasattr(event, "stop_signal"):
@@ -34,6 +98,10 @@ def stop_handler(event):
 gdb.events.stop.connect(stop_handler)
 
 
+# Questions queued with `why --batch`, answered along with the next plain `why`.
+batched_questions = []
+
+
 # Implement the command `why`
 class Why(gdb.Command):
     """Provides root cause analysis for a failure."""
@@ -47,97 +115,188 @@ class Why(gdb.Command):
         except:
             print("Must run the code first to ask `why`.")
             return
+        import chatdbg_utils
+
+        args, remaining = chatdbg_utils.parse_known_args(arg.split(), batch=True)
+        if args.batch:
+            if not remaining:
+                print("Usage: why --batch <question>")
+                return
+            batched_questions.append(" ".join(remaining))
+            print(
+                f"Queued question {len(batched_questions)}; it will be answered with the next `why`."
+            )
+            return
         global last_error_type
         if not last_error_type:
             # Assume we are running from a core dump,
             # which _probably_ means a SEGV.
             last_error_type = "SIGSEGV"
         the_prompt = buildPrompt()
-        args, _ = chatdbg_utils.parse_known_args(arg.split())
         if the_prompt:
-            # Call `explain` function with pieces of the_prompt  as arguments.
-            chatdbg_utils.explain(the_prompt[0], the_prompt[1], the_prompt[2], args)
+            if batched_questions:
+                # One request for all the queued questions, sharing the same context.
+                answered = chatdbg_utils.explain_batch(
+                    the_prompt[0],
+                    the_prompt[1],
+                    the_prompt[2],
+                    batched_questions[:],
+                    args,
+                )
+                # Keep the questions queued if the request didn't go through.
+                if answered:
+                    batched_questions.clear()
+            else:
+                # Call `explain` function with pieces of the_prompt  as arguments.
+                chatdbg_utils.explain(the_prompt[0], the_prompt[1], the_prompt[2], args)
 
 
 Why()
 
 
+# Per-frame info gathered by buildPrompt, keyed by (thread, pc, level).
+# Cleared on every stop, and whenever memory or registers may have changed
+# (e.g., `set var` or calling a function in the inferior).
+_frame_cache: dict[tuple[int, int, int], tuple] = {}
+
+# gdb.Frame.level() only exists in GDB 11 and later; older versions go uncached.
+_frame_cache_enabled = hasattr(gdb.Frame, "level")
+
+
+def state_changed_handler(event):
+    """Drops cached frame info, since argument values may have changed."""
+    _frame_cache.clear()
+
+
+gdb.events.memory_changed.connect(state_changed_handler)
+gdb.events.register_changed.connect(state_changed_handler)
+gdb.events.inferior_call.connect(state_changed_handler)
+
+
+def _frame_args(frame: gdb.Frame) -> list[tuple[str, str]]:
+    """
+    Returns (name, formatted value) pairs for the frame's arguments, or none
+    if the frame's function has no debug information.
+    """
+    args = []
+    if frame.function() is None:
+        # frame.block() would raise; checking first keeps the common case cheap.
+        return args
+    block = frame.block()
+    # The function's type says how many arguments there are, so we can stop
+    # walking the block's symbols (mostly locals) once we've seen them all.
+    try:
+        num_args = len(block.function.type.fields())
+    except (AttributeError, TypeError, RuntimeError):
+        num_args = None  # Not a function's outermost block; walk everything.
+    if num_args != 0:
+        for symbol in block:
+            if symbol.is_argument:
+                name = symbol.name
+                try:
+                    value = str(frame.read_var(name))
+                except gdb.error:
+                    value = "<unreadable>"
+                args.append((name, value))
+                if len(args) == num_args:
+                    break
+    return args
+
+
+def _frame_info(frame: gdb.Frame) -> tuple:
+    """
+    Returns (filename, func_name, args, lineno, colno) for the frame, where args
+    holds (name, formatted value) pairs. Reuses the result of an earlier `why`
+    at the same stop if there is one.
+    """
+    if _frame_cache_enabled:
+        key = (gdb.selected_thread().global_num, frame.pc(), frame.level())
+        if key in _frame_cache:
+            return _frame_cache[key]
+    # Interned, since the same names recur across frames and key the source cache.
+    func_name = frame.name()
+    if func_name is not None:
+        func_name = sys.intern(func_name)
+    symtab_and_line = frame.find_sal()
+    if symtab_and_line.symtab is not None:
+        filename = sys.intern(symtab_and_line.symtab.filename)
+    else:
+        filename = None
+    if symtab_and_line.line is not None:
+        lineno = symtab_and_line.line
+        colno = None
+    else:
+        lineno = None
+        colno = None
+    # Without a symtab there's no source, and no debug info to find arguments in.
+    args = _frame_args(frame) if filename is not None else []
+    info = (filename, func_name, args, lineno, colno)
+    if _frame_cache_enabled:
+        _frame_cache[key] = info
+    return info
+
+
 def buildPrompt() -> tuple[str, str, str]:
     thread = gdb.selected_thread()
     if not thread:
         return ""
 
-    stack_trace = ""
-    source_code = ""
+    stack_trace_parts = []
+    source_code_parts = []
 
-    frames = []
     frame = gdb.selected_frame()
 
-    # magic number - don't bother walking up more than this many frames.
+    # magic number - don't bother reporting more than this many frames.
     # This is just to prevent overwhelming OpenAI (or to cope with a stack overflow!).
     max_frames = 10
-
-    # Walk the stack and build up the frames list.
-    while frame is not None and max_frames > 0:
-        func_name = frame.name()
-        symtab_and_line = frame.find_sal()
-        if symtab_and_line.symtab is not None:
-            filename = symtab_and_line.symtab.filename
-        else:
-            filename = None
-        if symtab_and_line.line is not None:
-            lineno = symtab_and_line.line
-            colno = None
-        else:
-            lineno = None
-            colno = None
-        args = []
-        try:
-            block = frame.block()
-        except RuntimeError:
-            print(
-                "Your program must be compiled with debug information (`-g`) to use `why`."
-            )
-            return ""
-        for symbol in block:
-            if symbol.is_argument:
-                name = symbol.name
-                value = frame.read_var(name)
-                args.append((name, value))
-        frames.append((filename, func_name, args, lineno, colno))
-        frame = frame.older()
-        max_frames -= 1
-
-    # Now build the stack trace and source code strings.
-    for i, frame_info in enumerate(frames):
-        file_name = frame_info[0]
-        func_name = frame_info[1]
-        line_num = frame_info[3]
+    # Frames without source (e.g., inside libc) are skipped, but still bound the walk.
+    max_walked = 100
+
+    # Walk the stack, building the stack trace and source code strings as we go.
+    useful = 0
+    for _ in range(max_walked):
+        if frame is None or useful >= max_frames:
+            break
+        (file_name, func_name, args, line_num) = _frame_info(frame)[:4]
+        if file_name is None:
+            # No source (and so no arguments); nothing to tell the LLM about this frame.
+            frame = frame.older()
+            continue
+        i = useful
+        useful += 1
         arg_list = []
-        for arg in frame_info[2]:
-            arg_list.append(str(arg[1]))  # Note: arg[0] is the name of the argument
-        stack_trace += (
+        for arg in args:
+            arg_list.append(arg[1])  # Note: arg[0] is the name of the argument
+        stack_trace_parts.append(
             f'frame {i}: {func_name}({",".join(arg_list)}) at {file_name}:{line_num}\n'
         )
-        try:
-            source_code += f"/* frame {i} */\n"
-            (lines, first) = llm_utils.read_lines(filename, line_num - 10, line_num)
-            block = llm_utils.number_group_of_lines(lines, first)
-            source_code += f"{block}\n\n"
-        except:
-            # Couldn't find source for some reason. Skip file.
-            pass
+        if line_num is not None and file_name not in _missing_files:
+            try:
+                (lines, first) = read_lines(file_name, line_num - 10, line_num)
+                block = llm_utils.number_group_of_lines(lines, first)
+                source_code_parts.append(f"/* frame {i} */\n{block}\n\n")
+            except:
+                # Couldn't find source for some reason. Skip file from now on.
+                _missing_files.add(file_name)
+        frame = frame.older()
+
+    if useful == 0:
+        print(
+            "Your program must be compiled with debug information (`-g`) to use `why`."
+        )
+        return ""
 
     # If the Rust panic log exists, append it to the error reason.
-    global last_error_type
-    try:
-        with open(rust_panic_log_filename, "r") as log:
-            panic_log = log.read()
-        last_error_type = panic_log + "\n" + last_error_type
-    except:
-        pass
+    error_reason = last_error_type
+    panic_log = _read_panic_log()
+    if panic_log is not None:
+        error_reason = panic_log + "\n" + error_reason
+
+    return ("".join(source_code_parts), "".join(stack_trace_parts), error_reason)
 
-    return (source_code, stack_trace, last_error_type)
+
+# Type codes used by PrintTest, bound once to skip the gdb module attribute lookups.
+_PTR, _ARR, _STR = gdb.TYPE_CODE_PTR, gdb.TYPE_CODE_ARRAY, gdb.TYPE_CODE_STRUCT
 
 
 class PrintTest(gdb.Command):
@@ -168,84 +327,99 @@ class PrintTest(gdb.Command):
         addresses = {}
         for symbol in block:
             if symbol.is_argument or symbol.is_variable:
+                name = symbol.name
                 sym_val = frame.read_var(symbol)
                 # Returns python dictionary for each variable
-                variable = self._val_to_json(
-                    symbol.name, sym_val, recurse_max, addresses
-                )
-                js = json.dumps(variable, indent=4)
-                all_vars.append(js)
+                variable = self._val_to_json(name, sym_val, recurse_max, addresses)
+                all_vars.append(variable)
 
         # Print all addresses and JSON objects
         # print(addresses)
-        for j in all_vars:
-            print(j)
+        print(json.dumps(all_vars, indent=2))
 
     # Converts a gdb.Value to a JSON object
     def _val_to_json(self, name, val, max_recurse, address_book):
-        # Store address
-        address_book.setdefault(str(val.address.format_string()), name)
-
-        diction = {}
-        # Set var name
-        diction["name"] = name
-        # Set var type
-        if val.type.code is gdb.TYPE_CODE_PTR:
-            diction["type"] = "pointer"  # Default type name is "none"
-        elif val.type.code is gdb.TYPE_CODE_ARRAY:
-            diction["type"] = "array"  # Default type name is "none"
-        else:
-            diction["type"] = val.type.name
-        # Dereference pointers
-        if val.type.code is gdb.TYPE_CODE_PTR:
-            if val:
-                value = "->"
-                try:
-                    deref_val = val.referenced_value()
-                    # If dereferenced value is "seen", then get name from address book
-                    if deref_val.address.format_string() in address_book:
-                        diction["value"] = address_book[
-                            deref_val.address.format_string()
-                        ]
-                    else:
-                        # Recurse up to max_recurse times
-                        for i in range(max_recurse - 1):
-                            if deref_val.type.code is gdb.TYPE_CODE_PTR:
-                                value += "->"
-                                deref_val = deref_val.referenced_value()
-                            elif deref_val.type.code is gdb.TYPE_CODE_STRUCT:
-                                value = self._val_to_json(
-                                    value + name,
-                                    deref_val,
-                                    max_recurse - i - 1,
-                                    address_book,
-                                )
-                                break
-                            else:
-                                break
-                        # Append to -> string or not, depending on type of value
-                        if isinstance(value, dict):
-                            diction["value"] = value
-                        else:
-                            diction["value"] = value + deref_val.format_string()
-                except Exception as e:
-                    diction["value"] = value + "Exception"
-            else:
-                # Nullptr case, might be a better way to represent
-                diction["value"] = "nullptr"
-        # If struct, recurse through fields
-        elif val.type.code is gdb.TYPE_CODE_STRUCT:
-            fields = []
-            for f in val.type.fields():
-                fields.append(
-                    self._val_to_json(
-                        f.name, val[f.name], max_recurse - 1, address_book
+        # Store address. Registers and optimized-out values don't have one.
+        addr = val.address
+        if addr is not None:
+            address_book.setdefault(addr.format_string(), name)
+
+        # Each of these is a call into gdb, so only look them up once.
+        val_type = val.type
+        handler = self._type_handlers.get(val_type.code, PrintTest._scalar_to_json)
+        return handler(self, name, val, val_type, max_recurse, address_book)
+
+    # Dereference pointers
+    def _ptr_to_json(self, name, val, val_type, max_recurse, address_book):
+        diction = {"name": name, "type": "pointer"}  # Default type name is "none"
+        if not val:
+            # Nullptr case, might be a better way to represent
+            diction["value"] = "nullptr"
+            return diction
+        value = "->"
+        try:
+            deref_val = val.referenced_value()
+            # Recurse up to max_recurse times
+            for i in range(max_recurse):
+                # If dereferenced value is "seen", then get name from address book.
+                # Checking after every step (not just the first) keeps pointers to
+                # pointers from walking shared or cyclic structures again.
+                deref_addr = deref_val.address
+                if deref_addr is not None:
+                    deref_addr = deref_addr.format_string()
+                    if deref_addr in address_book:
+                        diction["value"] = address_book[deref_addr]
+                        return diction
+                if i == max_recurse - 1:
+                    break
+                deref_code = deref_val.type.code
+                if deref_code == _PTR:
+                    value += "->"
+                    deref_val = deref_val.referenced_value()
+                elif deref_code == _STR:
+                    value = self._val_to_json(
+                        value + name,
+                        deref_val,
+                        max_recurse - i - 1,
+                        address_book,
                     )
-                )
-            diction["value"] = fields
-        else:
-            diction["value"] = val.format_string()
+                    break
+                else:
+                    break
+            # Append to -> string or not, depending on type of value
+            if isinstance(value, dict):
+                diction["value"] = value
+            else:
+                diction["value"] = value + deref_val.format_string()
+        except Exception as e:
+            diction["value"] = value + "Exception"
         return diction
 
+    def _array_to_json(self, name, val, val_type, max_recurse, address_book):
+        # Default type name is "none"
+        return {"name": name, "type": "array", "value": val.format_string()}
+
+    # If struct, recurse through fields
+    def _struct_to_json(self, name, val, val_type, max_recurse, address_book):
+        fields = []
+        for f in val_type.fields():
+            field_name = f.name
+            fields.append(
+                self._val_to_json(
+                    field_name, val[field_name], max_recurse - 1, address_book
+                )
+            )
+        return {"name": name, "type": val_type.name, "value": fields}
+
+    def _scalar_to_json(self, name, val, val_type, max_recurse, address_book):
+        return {"name": name, "type": val_type.name, "value": val.format_string()}
+
+    # How _val_to_json handles each gdb.TYPE_CODE_*; anything else is a scalar.
+    _type_handlers = {
+        _PTR: _ptr_to_json,
+        _ARR: _array_to_json,
+        _STR: _struct_to_json,
+    }
+
 
 PrintTest()
@@ -1,5 +1,6 @@
 import argparse
 import os
+import re
 import textwrap
 from typing import Any, List, Optional, Tuple
 
@@ -39,7 +40,9 @@ class ChatDBGArgumentFormatter(argparse.HelpFormatter):
         return help
 
 
-def parse_known_args(argv: List[str]) -> Tuple[argparse.Namespace, List[str]]:
+def parse_known_args(
+    argv: List[str], batch: bool = False
+) -> Tuple[argparse.Namespace, List[str]]:
     description = textwrap.dedent(
         rf"""
             [b]ChatDBG[/b]: A Python debugger that uses AI to tell you `why`.
@@ -69,19 +72,19 @@ def parse_known_args(argv: List[str]) -> Tuple[argparse.Namespace, List[str]]:
         default=60,
         help="the timeout for API calls in seconds",
     )
+    if batch:
+        # Only the gdb backend supports queuing questions.
+        parser.add_argument(
+            "--batch",
+            action="store_true",
+            help="queue the rest of the line as a question, to be answered in the same request as the next `why`",
+        )
 
     return parser.parse_known_args(argv)
 
 
-def explain(
-    source_code: str, traceback: str, exception: str, args: argparse.Namespace
-) -> None:
-    user_prompt = f"""
-Explain what the root cause of this error is, given the following source code
-context for each stack frame and a traceback, and propose a fix. In your
-response, never refer to the frames given below (as in, 'frame 0'). Instead,
-always refer only to specific lines and filenames of source code.
-
+def _context(source_code: str, traceback: str, exception: str) -> str:
+    return f"""
 Source code for each stack frame:
 ```
 {source_code}
@@ -93,12 +96,14 @@ Traceback:
 Stop reason: {exception}
     """.strip()
 
+
+def _complete(user_prompt: str, args: argparse.Namespace) -> Optional[Any]:
     input_tokens = llm_utils.count_tokens(args.llm, user_prompt)
 
     if args.debug:
         print(user_prompt)
         print(f"Total input tokens: {input_tokens}")
-        return
+        return None
 
     try:
         client = openai.OpenAI(timeout=args.timeout)
@@ -106,26 +111,100 @@ Stop reason: {exception}
         print("You need an OpenAI key to use this tool.")
         print("You can get a key here: https://platform.openai.com/api-keys")
         print("Set the environment variable OPENAI_API_KEY to your key value.")
-        return
+        return None
 
     try:
-        completion = client.chat.completions.create(
+        return client.chat.completions.create(
             model=args.llm, messages=[{"role": "user", "content": user_prompt}]
         )
     except openai.NotFoundError:
         print(f"'{args.llm}' either does not exist or you do not have access to it.")
-        return
     except openai.RateLimitError:
         print("You have exceeded a rate limit or have no remaining funds.")
-        return
     except openai.APITimeoutError:
         print("The OpenAI API timed out.")
-        return
+    return None
 
-    text = completion.choices[0].message.content
-    print(llm_utils.word_wrap_except_code_blocks(text))
 
+def _print_cost(completion: Any, args: argparse.Namespace) -> None:
     input_tokens = completion.usage.prompt_tokens
     output_tokens = completion.usage.completion_tokens
     cost = llm_utils.calculate_cost(input_tokens, output_tokens, args.llm)
     print(f"\n(Total cost: approximately ${cost:.2f} USD.)")
+
+
+def explain(
+    source_code: str, traceback: str, exception: str, args: argparse.Namespace
+) -> None:
+    user_prompt = f"""
+Explain what the root cause of this error is, given the following source code
+context for each stack frame and a traceback, and propose a fix. In your
+response, never refer to the frames given below (as in, 'frame 0'). Instead,
+always refer only to specific lines and filenames of source code.
+
+{_context(source_code, traceback, exception)}
+    """.strip()
+
+    completion = _complete(user_prompt, args)
+    if completion is None:
+        return
+
+    text = completion.choices[0].message.content
+    print(llm_utils.word_wrap_except_code_blocks(text))
+    _print_cost(completion, args)
+
+
+def explain_batch(
+    source_code: str,
+    traceback: str,
+    exception: str,
+    questions: List[str],
+    args: argparse.Namespace,
+) -> bool:
+    """
+    Like explain, but answers the root cause question and each of the extra
+    questions in a single request that shares one copy of the debugger context.
+    Returns whether the questions were actually answered.
+    """
+    questions = [
+        "What is the root cause of this error, and how can it be fixed?"
+    ] + questions
+    numbered = "\n".join(f"[q{i}] {q}" for i, q in enumerate(questions, 1))
+    user_prompt = f"""
+Answer each of the following questions about an error, given the source code
+context for each stack frame and a traceback below. Begin the answer to each
+question with its identifier, so the answer to [q1] starts with [a1], the
+answer to [q2] starts with [a2], and so on. In your answers, never refer to
+the frames given below (as in, 'frame 0'). Instead, always refer only to
+specific lines and filenames of source code.
+
+{numbered}
+
+{_context(source_code, traceback, exception)}
+    """.strip()
+
+    completion = _complete(user_prompt, args)
+    if completion is None:
+        return False
+
+    text = completion.choices[0].message.content
+    # re.split with a group yields [preamble, "1", answer1, "2", answer2, ...].
+    # Tags only count at the start of a line, so code like `buf[a1]` isn't one.
+    pieces = re.split(r"^\s*\[a(\d+)\]", text, flags=re.M)
+    answers = {}
+    for number, answer in zip(pieces[1::2], pieces[2::2]):
+        answers[int(number)] = answer.strip()
+    if answers.keys() != set(range(1, len(questions) + 1)):
+        # The model didn't follow the format; show its response as-is.
+        print(llm_utils.word_wrap_except_code_blocks(text))
+    else:
+        preamble = pieces[0].strip()
+        if preamble:
+            print(llm_utils.word_wrap_except_code_blocks(preamble))
+            print()
+        for i, question in enumerate(questions, 1):
+            print(f"[{i}] {question}\n")
+            print(llm_utils.word_wrap_except_code_blocks(answers[i]))
+            print()
+    _print_cost(completion, args)
+    return True